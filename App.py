@@ -1,11 +1,11 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from fpdf import FPDF
-from fpdf.enums import XPos, YPos
+from fpdf.enums import XPos, YPos, MethodReturnValue
 import os
-import re
-import textwrap
 from datetime import datetime
+from functools import lru_cache
 import io
 
 # --- CONFIGURATION ---
@@ -24,38 +24,65 @@ DEFAULT_CREDITS = "Prepared By: Jain Sanghvi & Co."
 SIGNATURE_FONT_FILE = "DancingScript-Regular.ttf"
 LOGO_FILE = "logo.png"
 
+ADDRESS_COLS = (
+    'Ship To Address Line 1',
+    'Ship To Address Line 2',
+    'Ship To Address Line 3',
+    'Ship To City',
+    'Ship To State',
+    'Ship To ZIP Code',
+)
+
+# Only the columns the generator reads are parsed; IDs and codes stay strings (keeps leading zeros).
+# Heavily repeated ones are categories so grouping and matching compare integer codes.
+INVOICE_COLS = ('Invoice ID', 'Invoice date', 'Quantity', 'Item Cost', 'GST Rate', 'ASIN', 'HSN', 'Order ID')
+INVOICE_DTYPES = {
+    'Invoice ID': 'category',
+    'Invoice date': 'string',
+    'Quantity': 'Int32',
+    'Item Cost': 'string',
+    'GST Rate': 'category',
+    'ASIN': 'category',
+    'HSN': 'category',
+    'Order ID': 'category',
+}
+ORDER_COLS = ('Order ID',) + ADDRESS_COLS
+ORDER_DTYPES = {col: 'string' for col in ORDER_COLS}
+
 # --- Helper Functions (Copied from original script) ---
 
-def merge_address(order_row):
-    """Merge address fields from order data"""
-    cols = [
-        'Ship To Address Line 1',
-        'Ship To Address Line 2',
-        'Ship To Address Line 3',
-        'Ship To City',
-        'Ship To State',
-        'Ship To ZIP Code',
-    ]
-    address_parts = []
-    for col in cols:
-        val = str(order_row.get(col, ''))
-        if val and val != 'nan' and val.strip():
-            address_parts.append(val.strip())
-    return ', '.join(address_parts)
+def merge_addresses(orders_by_id):
+    """Merge address fields for every order at once - expects one row per Order ID (as index), returns {Order ID: address}"""
+    if orders_by_id.empty:
+        return {}
+    # Missing columns and empty cells both become '' and are skipped below
+    parts = orders_by_id.reindex(columns=list(ADDRESS_COLS)).fillna('').astype(str).apply(lambda col: col.str.strip())
+    # Join only the non-empty parts so the field text itself is never rewritten
+    merged = parts.apply(lambda row: ', '.join(val for val in row if val), axis=1)
+    return dict(zip(orders_by_id.index, merged))
+
+FILENAME_TRANSLATION = str.maketrans({c: '_' for c in '<>:"|?*/\\'})
 
 def sanitize_filename(filename):
     """Remove invalid characters from filename"""
-    filename = filename.replace('/', '_').replace('\\', '_')
-    filename = re.sub(r'[<>:"|?*]', '_', filename)
-    return filename
+    return filename.translate(FILENAME_TRANSLATION)
+
+DATE_FORMATS = ('%Y-%m-%d', '%d-%m-%Y')
 
 def format_date_only(date_str):
     """Extract only date from datetime string (remove time)"""
+    date_part = str(date_str).strip().partition(' ')[0]
+    # Fast path for the common export formats, pandas only for anything else
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(date_part, fmt).strftime('%d-%m-%Y')
+        except ValueError:
+            pass
     try:
         date_obj = pd.to_datetime(date_str)
         return date_obj.strftime('%d-%m-%Y')
     except (ValueError, TypeError):
-        return str(date_str).split(' ')[0]
+        return date_part
 
 def clean_currency(value):
     """Clean currency value - remove rupee symbol, commas, and convert to float"""
@@ -68,6 +95,38 @@ def clean_currency(value):
         print(f"Warning: Could not convert '{value}' to float")
         return 0.0
 
+def clean_currency_series(values):
+    """Vectorized clean_currency for a whole column - returns a float Series, unparseable values become 0.0"""
+    cleaned = values.astype(str).str.replace(r'[₹,]|Rs\.?', '', regex=True).str.strip()
+    return pd.to_numeric(cleaned, errors='coerce').fillna(0.0)
+
+UNITS = ("", "One", "Two", "Three", "Four", "Five", "Six", "Seven", "Eight", "Nine")
+TEENS = ("Ten", "Eleven", "Twelve", "Thirteen", "Fourteen", "Fifteen", "Sixteen", "Seventeen", "Eighteen", "Nineteen")
+TENS = ("", "Ten", "Twenty", "Thirty", "Forty", "Fifty", "Sixty", "Seventy", "Eighty", "Ninety")
+INDIAN_GROUPS = ((10000000, "Crore"), (100000, "Lakh"), (1000, "Thousand"), (100, "Hundred"))
+
+@lru_cache(maxsize=128)
+def two_digit_words(num):
+    """Words for 0-99"""
+    if num < 10: return UNITS[num]
+    if num < 20: return TEENS[num - 10]
+    return f"{TENS[num // 10]} {UNITS[num % 10]}".strip()
+
+def integer_to_words(num):
+    """Words for a whole number using Indian grouping (Crore, Lakh, Thousand, Hundred)"""
+    if num < 0:
+        raise ValueError(f"Cannot convert negative amount {num} to words")
+    words = []
+    for divisor, label in INDIAN_GROUPS:
+        count, num = divmod(num, divisor)
+        if count:
+            # Only the crore count can run past two digits
+            words.append(integer_to_words(count) if count >= 100 else two_digit_words(count))
+            words.append(label)
+    if num:
+        words.append(two_digit_words(num))
+    return " ".join(words)
+
 def number_to_words(n):
     """Converts a float number (like currency) to Indian numbering system words."""
     try:
@@ -75,40 +134,26 @@ def number_to_words(n):
         rupees = int(n)
         paise = int(round((n - rupees) * 100))
 
-        units = ["", "One", "Two", "Three", "Four", "Five", "Six", "Seven", "Eight", "Nine"]
-        teens = ["", "Eleven", "Twelve", "Thirteen", "Fourteen", "Fifteen", "Sixteen", "Seventeen", "Eighteen", "Nineteen"]
-        tens = ["", "Ten", "Twenty", "Thirty", "Forty", "Fifty", "Sixty", "Seventy", "Eighty", "Ninety"]
-
-        def convert_to_words(num):
-            if num == 0: return ""
-            if num < 10: return units[num]
-            if num == 10: return tens[1]
-            if num < 20: return teens[num - 10]
-            if num < 100: return tens[num // 10] + " " + units[num % 10]
-            if num < 1000: return units[num // 100] + " Hundred " + convert_to_words(num % 100)
-            if num < 100000: return convert_to_words(num // 1000) + " Thousand " + convert_to_words(num % 1000)
-            if num < 10000000: return convert_to_words(num // 100000) + " Lakh " + convert_to_words(num % 100000)
-            return convert_to_words(num // 10000000) + " Crore " + convert_to_words(num % 10000000)
-
-        rupees_words = convert_to_words(rupees).strip()
-        paise_words = convert_to_words(paise).strip()
-
-        result = ""
-        if rupees_words:
-            result = f"Rupees {rupees_words.strip()}"
-        else:
-            result = "Rupees Zero"
+        rupees_words = integer_to_words(rupees)
+        paise_words = integer_to_words(paise)
 
+        result = f"Rupees {rupees_words or 'Zero'}"
         if paise_words:
-            result += f" and {paise_words.strip()} Paise"
+            result += f" and {paise_words} Paise"
         
-        return result.replace("  ", " ") + " Only"
+        return result + " Only"
 
     except Exception as e:
         print(f"Error converting number to words: {e}")
         return "Error"
 
 
+@st.cache_data(show_spinner=False, max_entries=4) # Shared across sessions - keep only a few recent files
+def load_csv(file_bytes, columns, dtype):
+    """Parse an uploaded CSV - cached on the file contents so reruns and re-uploads skip the parse"""
+    return pd.read_csv(io.BytesIO(file_bytes), usecols=lambda col: col in columns, dtype=dtype, engine='c')
+
+
 # --- Professional PDF Class (Copied from original script) ---
 
 class PDFInvoice(FPDF):
@@ -124,8 +169,8 @@ class PDFInvoice(FPDF):
         self.signature_font_available = False
         try:
             if os.path.exists(SIGNATURE_FONT_FILE):
-                # Added uni=True to properly process the TTF font
-                self.add_font('DancingScript', '', SIGNATURE_FONT_FILE, uni=True) 
+                # fpdf2 loads TTF fonts as unicode, no uni flag needed
+                self.add_font('DancingScript', '', SIGNATURE_FONT_FILE)
                 self.signature_font_available = True
             else:
                  print(f"Warning: Signature font '{SIGNATURE_FONT_FILE}' not found. Skipping.")
@@ -197,17 +242,48 @@ class PDFInvoice(FPDF):
             self.cell(col_widths[i], 7, col, border=1, align=align, fill=True)
         self.ln()
     
-    def draw_invoice_table_row(self, col_widths, vals):
-        self.set_font("Helvetica", '', 8)
-        for i, val in enumerate(vals):
-            # Sr, Qty, Rate, Amount, CGST, SGST, Total are right-aligned
-            align = 'R' if i in [0, 3, 4, 5, 7, 8, 9] else 'L'
-            # HSN, GST% are centered
-            if i in [2, 6]: 
-                align = 'C'
-            # ASIN is left-aligned (index 1)
-            self.cell(col_widths[i], 6, str(val), border=1, align=align)
-        self.ln()
+    # Sr, Qty, Rate, Amount, CGST, SGST, Total are right-aligned; HSN, GST% centered; ASIN left-aligned
+    ROW_ALIGNS = ('R', 'L', 'C', 'R', 'R', 'R', 'C', 'R', 'R', 'R')
+
+    def draw_invoice_table_row(self, col_widths, vals, h=6):
+        """Draws a body row straight into the content stream - one path for all borders, one text object for all cells.
+        Uses the current font, so set it once before drawing the rows."""
+        if self.will_page_break(h):
+            self.add_page()
+
+        k = self.k
+        x0, y = self.x, self.y
+        top = (self.h - y) * k
+        bottom = (self.h - y - h) * k
+        baseline = (self.h - y - 0.5 * h - 0.3 * self.font_size) * k
+
+        # Outer rectangle plus the inner vertical separators, stroked once
+        path = [f"{x0 * k:.2f} {top:.2f} {sum(col_widths) * k:.2f} {-h * k:.2f} re"]
+        text = []
+        x = x0
+        for i, (w, val, align) in enumerate(zip(col_widths, vals, self.ROW_ALIGNS)):
+            if i:
+                path.append(f"{x * k:.2f} {top:.2f} m {x * k:.2f} {bottom:.2f} l")
+            val = self.normalize_text(str(val)) # Same encoding checks and substitutions as cell()
+            if val:
+                if align == 'R':
+                    dx = w - self.c_margin - self.get_string_width(val)
+                elif align == 'C':
+                    dx = (w - self.get_string_width(val)) / 2
+                else:
+                    dx = self.c_margin
+                text.append(f"1 0 0 1 {(x + dx) * k:.2f} {baseline:.2f} Tm {self.current_font.encode_text(val)}")
+            x += w
+        path.append("S")
+
+        # Select the font outside q/Q so it stays active on the page, as fpdf2 itself assumes afterwards
+        font_op = ""
+        if not self.current_font_is_set_on_page:
+            font_op = self._set_font_for_page(self.current_font, self.font_size_pt) + "\n"
+
+        # Single append per row - fpdf2 already accumulates page content in a bytearray
+        self._out(f"{font_op}{' '.join(path)}\nq {self.text_color.serialize().lower()} BT {' '.join(text)} ET Q")
+        self.set_xy(self.l_margin, y + h)
 
     def draw_totals_summary(self, total_amount, total_cgst, total_sgst, grand_total):
         self.ln(2)
@@ -289,10 +365,16 @@ st.set_page_config(page_title="GST Invoice Generator", layout="centered", page_i
 # Initialize session state
 if 'invoice_df' not in st.session_state:
     st.session_state.invoice_df = None
-if 'orders_df' not in st.session_state:
-    st.session_state.orders_df = None
+if 'invoice_groups' not in st.session_state:
+    st.session_state.invoice_groups = {}
+if 'orders_by_id' not in st.session_state:
+    st.session_state.orders_by_id = None
 if 'invoice_ids' not in st.session_state:
     st.session_state.invoice_ids = ["---"]
+if 'invoice_file_id' not in st.session_state:
+    st.session_state.invoice_file_id = None
+if 'orders_file_id' not in st.session_state:
+    st.session_state.orders_file_id = None
 if 'pdf_bytes' not in st.session_state:
     st.session_state.pdf_bytes = None
 if 'pdf_filename' not in st.session_state:
@@ -302,25 +384,40 @@ if 'pdf_filename' not in st.session_state:
 with st.sidebar:
     st.header("1. Upload Files")
     
+    # Files are only parsed (and grouped) when a new upload arrives; other reruns reuse
+    # the session copy, and load_csv's cache covers re-uploading the same file
     invoice_file = st.file_uploader("Upload Invoice CSV", type="csv")
-    if invoice_file:
+    if invoice_file and invoice_file.file_id != st.session_state.invoice_file_id:
         try:
-            st.session_state.invoice_df = pd.read_csv(invoice_file)
-            st.session_state.invoice_ids = st.session_state.invoice_df['Invoice ID'].unique().tolist()
-            st.success("Invoice CSV loaded! ✓")
+            st.session_state.invoice_df = load_csv(invoice_file.getvalue(), INVOICE_COLS, INVOICE_DTYPES)
+            # Group once so each generation is a dict lookup instead of a full scan
+            st.session_state.invoice_groups = {
+                inv_id: group for inv_id, group in st.session_state.invoice_df.groupby('Invoice ID', sort=False, observed=True)
+            }
+            st.session_state.invoice_ids = list(st.session_state.invoice_groups)
+            st.session_state.invoice_file_id = invoice_file.file_id
         except Exception as e:
             st.error(f"Failed to load Invoice CSV: {e}")
             st.session_state.invoice_df = None
+            st.session_state.invoice_groups = {}
             st.session_state.invoice_ids = ["---"]
+            st.session_state.invoice_file_id = None
+    if invoice_file and st.session_state.invoice_df is not None:
+        st.success("Invoice CSV loaded! ✓")
 
     orders_file = st.file_uploader("Upload Order CSV", type="csv")
-    if orders_file:
+    if orders_file and orders_file.file_id != st.session_state.orders_file_id:
         try:
-            st.session_state.orders_df = pd.read_csv(orders_file)
-            st.success("Order CSV loaded! ✓")
+            orders_df = load_csv(orders_file.getvalue(), ORDER_COLS, ORDER_DTYPES)
+            # First row per order wins, indexed for direct Order ID lookups
+            st.session_state.orders_by_id = orders_df.drop_duplicates('Order ID').set_index('Order ID')
+            st.session_state.orders_file_id = orders_file.file_id
         except Exception as e:
             st.error(f"Failed to load Order CSV: {e}")
-            st.session_state.orders_df = None
+            st.session_state.orders_by_id = None
+            st.session_state.orders_file_id = None
+    if orders_file and st.session_state.orders_by_id is not None:
+        st.success("Order CSV loaded! ✓")
     
     st.divider()
     st.header("2. Select Invoice")
@@ -351,7 +448,7 @@ if st.button("🔄 Generate Merged PDF", type="primary", use_container_width=Tru
     st.session_state.pdf_bytes = None # Clear previous PDF
     
     # --- Error Checking ---
-    if st.session_state.invoice_df is None or st.session_state.orders_df is None:
+    if st.session_state.invoice_df is None or st.session_state.orders_by_id is None:
         st.error("Error: Please upload both Invoice and Order CSV files.")
     elif selected_invoice_id == "---" or not selected_invoice_id:
         st.error("Error: Please select a valid Invoice ID.")
@@ -363,12 +460,17 @@ if st.button("🔄 Generate Merged PDF", type="primary", use_container_width=Tru
                 # Get company name from first line of Bill From
                 company_name = bill_from_data.split('\n')[0].strip().replace(',', '')
                 
-                # Filter invoice data for selected invoice ID
-                sub_inv = st.session_state.invoice_df[st.session_state.invoice_df['Invoice ID'] == selected_invoice_id]
+                # Invoice rows for selected invoice ID
+                sub_inv = st.session_state.invoice_groups.get(selected_invoice_id)
                 
-                if sub_inv.empty:
+                if sub_inv is None or sub_inv.empty:
                     st.error("Error: No data found for selected Invoice ID.")
                 else:
+                    # Order ID -> address for this invoice's orders only, selected in one isin() scan
+                    inv_orders = sub_inv['Order ID'].unique().tolist()
+                    orders_by_id = st.session_state.orders_by_id
+                    addr_map = merge_addresses(orders_by_id.loc[orders_by_id.index.isin(inv_orders)])
+                    
                     # --- Create Invoice PDF ---
                     pdf = PDFInvoice(bill_from=bill_from_data, bill_to=bill_to_data, 
                                      company_name=company_name)
@@ -389,43 +491,36 @@ if st.button("🔄 Generate Merged PDF", type="primary", use_container_width=Tru
                     pdf.draw_invoice_table_header(col_widths, col_names)
                     
                     # --- Table data ---
-                    grand_total = 0
-                    total_cgst = 0
-                    total_sgst = 0
-                    total_amount = 0
-                    total_qty = 0 
-                    serial_number = 1 
-                    
-                    for idx, row in sub_inv.iterrows():
-                        qty = int(row['Quantity'])
-                        item_cost = clean_currency(row['Item Cost'])
-                        rate = item_cost / qty if qty else 0
-                        gst_rate_str = str(row['GST Rate']).replace('%', '').strip()
-                        gst_rate = float(gst_rate_str)
-                        cgst_amt = item_cost * gst_rate / 100 / 2
-                        sgst_amt = item_cost * gst_rate / 100 / 2
-                        total = item_cost + cgst_amt + sgst_amt
-                        
-                        total_amount += item_cost
-                        total_cgst += cgst_amt
-                        total_sgst += sgst_amt
-                        grand_total += total
-                        total_qty += qty 
-                        
-                        vals = [
-                            str(serial_number), # Sr.
-                            str(row['ASIN']), # ASIN (no trim)
-                            str(row['HSN'])[:18], # HSN
-                            str(qty), # Qty
-                            f"{rate:.2f}", # Rate
-                            f"{item_cost:.2f}", # Amount
-                            f"{gst_rate:.0f}%", # GST%
-                            f"{cgst_amt:.2f}", # CGST
-                            f"{sgst_amt:.2f}", # SGST
-                            f"{total:.2f}" # Total
-                        ]
+                    # Precompute all numeric columns in one vectorized pass
+                    qtys = sub_inv['Quantity'].astype(int).to_numpy()
+                    item_costs = clean_currency_series(sub_inv['Item Cost']).to_numpy(dtype=float)
+                    gst_rates = sub_inv['GST Rate'].astype(str).str.replace('%', '').str.strip().astype(float).to_numpy()
+                    cgst_amts = sgst_amts = item_costs * gst_rates / 200 # GST is split evenly between CGST and SGST
+                    totals = item_costs + cgst_amts + sgst_amts
+                    rates = np.divide(item_costs, qtys, out=np.zeros_like(item_costs), where=qtys != 0)
+
+                    total_amount = float(item_costs.sum())
+                    total_cgst = float(cgst_amts.sum())
+                    total_sgst = total_cgst
+                    grand_total = float(totals.sum())
+                    total_qty = int(qtys.sum())
+
+                    pdf.set_font("Helvetica", '', 8) # Body font, set once for all rows
+                    # Format every column in one vectorized pass, the loop only draws
+                    rows = zip(
+                        np.char.mod('%d', np.arange(1, len(qtys) + 1)), # Sr.
+                        sub_inv['ASIN'].astype('string').fillna('').to_numpy(), # ASIN (no trim)
+                        sub_inv['HSN'].astype('string').fillna('').str.slice(0, 18).to_numpy(), # HSN
+                        np.char.mod('%d', qtys), # Qty
+                        np.char.mod('%.2f', rates), # Rate
+                        np.char.mod('%.2f', item_costs), # Amount
+                        np.char.mod('%.0f%%', gst_rates), # GST%
+                        np.char.mod('%.2f', cgst_amts), # CGST
+                        np.char.mod('%.2f', sgst_amts), # SGST
+                        np.char.mod('%.2f', totals), # Total
+                    )
+                    for vals in rows:
                         pdf.draw_invoice_table_row(col_widths, vals)
-                        serial_number += 1
                     
                     # --- Draw Table Total Row ---
                     pdf.set_font("Helvetica", 'B', 9)
@@ -466,52 +561,24 @@ if st.button("🔄 Generate Merged PDF", type="primary", use_container_width=Tru
                     pdf.ln()
                     
                     pdf.set_font('Helvetica', '', 9)
-                    inv_orders = sub_inv['Order ID'].unique().tolist()
-                    
-                    # --- SIMPLE LINE BREAK ANNEXURE LOOP ---
+                    # --- ANNEXURE LOOP ---
+                    address_width_mm = pdf.w - pdf.r_margin - pdf.l_margin - 35 - 45
                     for oid in inv_orders:
-                        order_match = st.session_state.orders_df[st.session_state.orders_df['Order ID'] == oid]
-                        
-                        addr = 'Address not found'
-                        if not order_match.empty:
-                            order_row = order_match.iloc[0]
-                            addr = merge_address(order_row)
-
-                        # 1. Wrap the address text
-                        address_width_mm = pdf.w - pdf.r_margin - pdf.l_margin - 35 - 45
-                        # Estimate chars per line (approx 2.2mm per char for 9pt)
-                        try:
-                            # A better guess: mm / (font_size_pt * 0.35 * 0.7)
-                            chars_per_line = int(address_width_mm / (9 * 0.35 * 0.7)) 
-                        except ZeroDivisionError:
-                            chars_per_line = 45 # A safe default
-                        
-                        lines = textwrap.wrap(addr, width=chars_per_line, replace_whitespace=False, drop_whitespace=False)
-                        if not lines:
-                            lines = [''] # Ensure at least one line
-
-                        # 2. Print the first line with all data
-                        pdf.cell(35, 7, str(oid), 1, align='L')
-                        pdf.cell(45, 7, str(selected_invoice_id), 1, align='L')
-                        pdf.cell(0, 7, lines[0], 1, align='L') # `0` width goes to margin
-                        pdf.ln()
-                        
-                        # 3. Print remaining lines, with blank cells for first two cols
-                        if len(lines) > 1:
-                            for line in lines[1:]:
-                                pdf.cell(35, 7, '', 1, align='L') # Blank cell
-                                pdf.cell(45, 7, '', 1, align='L') # Blank cell
-                                pdf.cell(0, 7, line, 1, align='L')
-                                pdf.ln()
+                        addr = addr_map.get(oid, 'Address not found')
+
+                        # Measure the wrapped address with real glyph widths so the side cells match its height
+                        lines = pdf.multi_cell(address_width_mm, 7, addr, border=1, align='L',
+                                               dry_run=True, output=MethodReturnValue.LINES)
+                        row_h = 7 * max(1, len(lines))
+
+                        pdf.cell(35, row_h, str(oid), 1, align='L')
+                        pdf.cell(45, row_h, str(selected_invoice_id), 1, align='L')
+                        pdf.multi_cell(0, 7, addr, 1, align='L', new_x=XPos.LMARGIN, new_y=YPos.NEXT) # `0` width goes to margin
                     
                     # --- Finalize PDF in memory ---
-                    # 
-                    #  THE FIX IS HERE:
-                    #  pdf.output(dest='S') already returns bytes, no .encode() needed
-                    #
-                    pdf_bytes = bytes(pdf.output(dest='S'))
-                    
-                    st.session_state.pdf_bytes = pdf_bytes
+                    # pdf.output() returns a bytearray; st.download_button only accepts bytes,
+                    # so this single conversion is the only copy made
+                    st.session_state.pdf_bytes = bytes(pdf.output())
                     safe_invoice_id = sanitize_filename(selected_invoice_id)
                     st.session_state.pdf_filename = f"Invoice_Annexure_{safe_invoice_id}.pdf"
                     